@@ -1,462 +1,637 @@
+from __future__ import annotations
+
 import streamlit as st
-import pandas as pd
+import asyncio
+import gzip
+import io
 import json
 import os
-from google import genai
+import pickle
+import queue
+import re
+import threading
+import orjson
+import xxhash
+from tenacity import retry, retry_if_exception, wait_exponential_jitter
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from schemas import (
+    pfd_prompt, pfd_schema, PFD_SCHEMA_JSON,
+    cp_prompt, cp_schema, CP_SCHEMA_JSON,
+    pfmea_prompt, pfmea_schema, PFMEA_SCHEMA_JSON,
+    consistency_prompt, consistency_schema, CONSISTENCY_SCHEMA_JSON,
+    combined_prompt, combined_schema, COMBINED_SCHEMA_JSON
+)
+
+# pandas and the Gemini SDK are heavy to import; they are loaded on first use inside
+# the functions below so a cold start does not pay for them up front.
+if TYPE_CHECKING:
+    import pandas as pd
 
 # ======= Gemini Client =======
-api_key = os.environ.get("GENIE_API_KEY")  # Set this in Streamlit secrets or env vars
-client = genai.Client(api_key=api_key)
-
-# ======= PFD Prompt (updated for row_content) =======
-pfd_prompt = """
-You are a Quality Assurance assistant for PPAP documentation.
-Analyze the provided Process Flow Diagram (PFD).
-
-Use the latest AIAG guidance (APQP 3rd Edition, March 2024).
-
-Return JSON only with two keys:
-
-1. summary:
-   - product_outline: story-like description of the product/component
-   - total_steps
-   - machines_tools_list
-   - special_characteristics_count
-   - pfmea_refs
-   - control_plan_refs
-
-2. missed_points:
-   - Array of objects:
-     - issue
-     - severity (high/medium/low)
-     - row_content (string: include the full row content from the PFD)
-     - suggestion
-"""
-
-# ======= Updated schema =======
-pfd_schema = {
-    "type": "object",
-    "properties": {
-        "summary": {
-            "type": "object",
-            "properties": {
-                "product_outline": {"type": "string"},
-                "total_steps": {"type": "integer"},
-                "machines_tools_list": {"type": "array", "items": {"type": "string"}},
-                "special_characteristics_count": {"type": "integer"},
-                "pfmea_refs": {"type": "array", "items": {"type": "string"}},
-                "control_plan_refs": {"type": "array", "items": {"type": "string"}}
-            },
-            "required": [
-                "product_outline", "total_steps", "machines_tools_list",
-                "special_characteristics_count", "pfmea_refs", "control_plan_refs"
-            ]
-        },
-        "missed_points": {
-            "type": "array",
-            "items": {
-                "type": "object",
-                "properties": {
-                    "issue": {"type": "string"},
-                    "severity": {"type": "string"},
-                    "row_content": {"type": "string"},
-                    "suggestion": {"type": "string"}
-                },
-                "required": ["issue", "severity", "row_content", "suggestion"]
-            }
-        }
-    },
-    "required": ["summary", "missed_points"]
-}
-# ======= Control Plan Prompt =======
-# ======= Control Plan Prompt (updated for row_content) =======
-cp_prompt = """
-You are a Quality Assurance assistant for PPAP documentation.
-Analyze the provided Control Plan (CP).
-
-Use the latest AIAG guidance (Control Plan Reference Manual – 1st Edition, March 2024).
-
-Return JSON only with two keys:
-
-1. summary:
-   - product_outline: story-like description of the product/component
-   - total_control_items
-   - safe_launch_controls (count + description)
-   - ownership_clarity (Yes/No + details)
-   - automation_readiness (Yes/No + comments)
-
-2. missed_points:
-   - Array of objects:
-     - issue
-     - severity (high/medium/low)
-     - row_content (string: include the full row content from the Control Plan)
-     - suggestion
-"""
-
-# ======= Updated schema =======
-cp_schema = {
-    "type": "object",
-    "properties": {
-        "summary": {
-            "type": "object",
-            "properties": {
-                "product_outline": {"type": "string"},
-                "total_control_items": {"type": "integer"},
-                "safe_launch_controls": {
-                    "type": "object",
-                    "properties": {
-                        "count": {"type": "integer"},
-                        "description": {"type": "string"}
-                    }
-                },
-                "ownership_clarity": {"type": "string"},
-                "automation_readiness": {"type": "string"}
-            },
-            "required": [
-                "product_outline", "total_control_items", "safe_launch_controls",
-                "ownership_clarity", "automation_readiness"
-            ]
-        },
-        "missed_points": {
-            "type": "array",
-            "items": {
-                "type": "object",
-                "properties": {
-                    "issue": {"type": "string"},
-                    "severity": {"type": "string"},
-                    "row_content": {"type": "string"},
-                    "suggestion": {"type": "string"}
-                },
-                "required": ["issue", "severity", "row_content", "suggestion"]
-            }
-        }
-    },
-    "required": ["summary", "missed_points"]
-}
-# ======= PFMEA Prompt =======
-# ======= PFMEA Prompt (updated for row_content) =======
-pfmea_prompt = """
-You are a Quality Assurance assistant for PPAP documentation.
-Analyze the provided PFMEA.
-
-Use the latest AIAG-VDA FMEA Handbook (2019) as reference.
-
-Return JSON only with two keys:
-
-1. summary:
-   - product_outline: story-like description of the process/product
-   - total_failure_modes
-   - high_rpn_count
-   - action_priority_summary (high/medium/low counts)
-   - linkage_to_pfd (Yes/No + details)
-   - linkage_to_control_plan (Yes/No + details)
-
-2. missed_points:
-   - Array of objects:
-     - issue
-     - severity (high/medium/low)
-     - row_content (string: include the full row content from the PFMEA)
-     - suggestion
-"""
-
-# ======= Updated PFMEA schema =======
-pfmea_schema = {
-    "type": "object",
-    "properties": {
-        "summary": {
-            "type": "object",
-            "properties": {
-                "product_outline": {"type": "string"},
-                "total_failure_modes": {"type": "integer"},
-                "high_rpn_count": {"type": "integer"},
-                "action_priority_summary": {
-                    "type": "object",
-                    "properties": {
-                        "high": {"type": "integer"},
-                        "medium": {"type": "integer"},
-                        "low": {"type": "integer"}
-                    }
-                },
-                "linkage_to_pfd": {"type": "string"},
-                "linkage_to_control_plan": {"type": "string"}
-            },
-            "required": [
-                "product_outline", "total_failure_modes", "high_rpn_count",
-                "action_priority_summary", "linkage_to_pfd", "linkage_to_control_plan"
-            ]
-        },
-        "missed_points": {
-            "type": "array",
-            "items": {
-                "type": "object",
-                "properties": {
-                    "issue": {"type": "string"},
-                    "severity": {"type": "string"},
-                    "row_content": {"type": "string"},
-                    "suggestion": {"type": "string"}
-                },
-                "required": ["issue", "severity", "row_content", "suggestion"]
-            }
-        }
-    },
-    "required": ["summary", "missed_points"]
-}
-# ======= Consistency Prompt =======
-consistency_prompt = """
-You are a Quality Assurance assistant for PPAP documentation.
-Check the consistency between Process Flow Diagram (PFD), Control Plan (CP), and PFMEA.
-
-Rules:
-- Every process step in PFD must appear in Control Plan.
-- Every control in Control Plan must be referenced in PFMEA.
-- Any missing linkage must be identified.
-
-Return JSON only with two keys:
-
-1. summary:
-   - total_pfd_steps
-   - total_cp_controls
-   - total_pfmea_entries
-   - linked_pfd_to_cp (count)
-   - linked_cp_to_pfmea (count)
-   - linkage_completeness (percentage of proper linkages)
-
-2. missing_links:
-   - Array of objects:
-     - from_document (PFD / CP)
-     - missing_in (CP / PFMEA)
-     - row_content (string: include the full row content causing the missing linkage)
-     - description
-     - suggestion
-"""
-
-# ======= Updated Consistency Schema =======
-consistency_schema = {
-    "type": "object",
-    "properties": {
-        "summary": {
-            "type": "object",
-            "properties": {
-                "total_pfd_steps": {"type": "integer"},
-                "total_cp_controls": {"type": "integer"},
-                "total_pfmea_entries": {"type": "integer"},
-                "linked_pfd_to_cp": {"type": "integer"},
-                "linked_cp_to_pfmea": {"type": "integer"},
-                "linkage_completeness": {"type": "number"}
-            },
-            "required": [
-                "total_pfd_steps", "total_cp_controls", "total_pfmea_entries",
-                "linked_pfd_to_cp", "linked_cp_to_pfmea", "linkage_completeness"
-            ]
-        },
-        "missing_links": {
-            "type": "array",
-            "items": {
-                "type": "object",
-                "properties": {
-                    "from_document": {"type": "string"},
-                    "missing_in": {"type": "string"},
-                    "row_content": {"type": "string"},
-                    "description": {"type": "string"},
-                    "suggestion": {"type": "string"}
-                },
-                "required": ["from_document", "missing_in", "row_content", "description", "suggestion"]
-            }
-        }
-    },
-    "required": ["summary", "missing_links"]
+# Built once per process and shared across reruns and sessions.
+# Every request is bounded by REQUEST_TIMEOUT; a stalled call is retried once, straight
+# away, so the tail latency stays bounded. Overload responses (HTTP 429 rate limits,
+# likely when shards run in parallel, and 503) back off with jittered exponential
+# waits, up to RETRY_ATTEMPTS attempts in total.
+REQUEST_TIMEOUT = 60  # seconds
+TIMEOUT_ATTEMPTS = 2
+RETRY_ATTEMPTS = 5
+# Flash is the default: structured extraction is well within its reach and it is much
+# faster and cheaper than Pro, which stays available per tab.
+MODELS = ["gemini-1.5-flash", "gemini-2.5-pro"]
+
+def get_api_key():
+    # Streamlit secrets take precedence; fall back to the environment. Resolved on
+    # first use, so the app still starts without a secrets.toml.
+    try:
+        return st.secrets["GENIE_API_KEY"]
+    except (KeyError, FileNotFoundError):
+        return os.environ.get("GENIE_API_KEY")
+
+@st.cache_resource
+def get_client():
+    from google import genai
+
+    return genai.Client(api_key=get_api_key(), http_options={"timeout": REQUEST_TIMEOUT * 1000})
+
+def is_timeout(exc: BaseException | None) -> bool:
+    import httpx
+
+    return isinstance(exc, httpx.TimeoutException)
+
+def is_overloaded(exc: BaseException | None) -> bool:
+    from google.genai import errors
+
+    return isinstance(exc, errors.APIError) and exc.code in (429, 503)
+
+overload_backoff = wait_exponential_jitter(initial=1, max=30)
+
+def retry_wait(retry_state) -> float:
+    return 0 if is_timeout(retry_state.outcome.exception()) else overload_backoff(retry_state)
+
+def retry_stop(retry_state) -> bool:
+    limit = TIMEOUT_ATTEMPTS if is_timeout(retry_state.outcome.exception()) else RETRY_ATTEMPTS
+    return retry_state.attempt_number >= limit
+
+# Replies are streamed; when a `progress` queue is given, the text received so far is
+# pushed to it after every chunk so the UI can show results before the reply is complete.
+@retry(
+    retry=retry_if_exception(lambda exc: is_timeout(exc) or is_overloaded(exc)),
+    wait=retry_wait,
+    stop=retry_stop,
+    reraise=True
+)
+def generate(request: dict, progress: queue.Queue | None = None) -> str:
+    text = ""
+    for chunk in get_client().models.generate_content_stream(**request):
+        text += chunk.text or ""
+        if progress is not None:
+            progress.put(text)
+    return text
+
+# ======= Upload parsing =======
+# Keyed on the file bytes, so reruns and identical re-uploads skip the parse.
+# Both readers are native (Arrow's CSV reader, Rust calamine for xlsx, which pandas
+# supports from 2.2), and columns are Arrow-backed so strings are not boxed into one
+# Python object per cell.
+# Upload bytes are hashed with xxh3 rather than Streamlit's default digest.
+@st.cache_data(show_spinner=False, hash_funcs={bytes: xxhash.xxh3_64_hexdigest})
+def load_table(file_bytes: bytes, file_type: str) -> pd.DataFrame:
+    import pandas as pd
+
+    buf = io.BytesIO(file_bytes)
+    if file_type == "csv":
+        # Blank lines are kept (as empty rows, dropped later by compact()) so the frame
+        # index still lines up with the file's line numbers.
+        return pd.read_csv(buf, engine="pyarrow", dtype_backend="pyarrow", skip_blank_lines=False)
+    return pd.read_excel(buf, engine="calamine", dtype_backend="pyarrow")
+
+def read_upload(uploaded_file) -> pd.DataFrame:
+    # Only the file type joins the bytes in the cache key, so the same sheet uploaded
+    # under another name (e.g. again in the Consistency Checker) is not parsed twice.
+    file_type = "csv" if uploaded_file.name.lower().endswith(".csv") else "xlsx"
+    return load_table(uploaded_file.getvalue(), file_type)
+
+def file_digest(uploaded_file) -> str:
+    return xxhash.xxh3_64_hexdigest(uploaded_file.getvalue())
+
+PREVIEW_ROWS = 5
+PREVIEW_COLUMNS = 12
+
+def preview(df: pd.DataFrame) -> pd.DataFrame:
+    # Wide PPAP sheets make st.dataframe slow to serialize; show only the top-left
+    # corner. Columns are already Arrow-backed (see load_table), so no cast is needed.
+    return df.iloc[:PREVIEW_ROWS, :PREVIEW_COLUMNS]
+
+# ======= LLM payload =======
+# Metadata columns (author, revision, dates, sign-offs) say nothing about the process
+# and are not sent to Gemini. A header is dropped only when every word in it is a
+# metadata word, so content headers that merely mention one ("Responsibility & Target
+# Completion Date") are kept. Everything else, including all free-text columns that the
+# prompts quote back as row_content, is sent.
+METADATA_WORDS = {
+    "author", "prepared", "approved", "approver", "reviewed", "reviewer",
+    "signature", "sign", "off", "revision", "rev", "version", "level", "date", "dated",
+    "timestamp", "created", "modified", "updated", "last", "orig", "original",
+    "printed", "page", "by", "at", "on", "of"
 }
 
-
-# ======= Streamlit UI =======
-st.title("📊 AIAG PPAP Analyzer Suite")
-tabs = st.tabs([
-    "🔹 PFD Analyzer",
-    "🔹 Control Plan Analyzer",
-    "🔹 PFMEA Analyzer",
-    "🔹 Consistency Checker"
-])
-
-# --- PFD Analyzer ---
-with tabs[0]:
-# ======= Streamlit UI =======
-   st.title("📘 AIAG PFD Analyzer (APQP 3rd Edition)")
-
-   uploaded_file = st.file_uploader("Upload PFD (Excel or CSV)", type=["xlsx", "csv"])
-
-   if uploaded_file:
-       if uploaded_file.name.endswith(".csv"):
-           df = pd.read_csv(uploaded_file)
-       else:
-           df = pd.read_excel(uploaded_file)
-
-       st.subheader("Preview of uploaded file")
-       st.dataframe(df.head())
-
-       content_text = df.to_csv(index=False)
-
-       # Call Gemini
-       with st.spinner("Analyzing PFD..."):
-           response = client.models.generate_content(
-               model="gemini-1.5-flash",
-               contents=[{"parts": [{"text": pfd_prompt}, {"text": content_text}]}],
-               config={"response_mime_type": "application/json", "response_schema": pfd_schema}
+def is_metadata_column(name) -> bool:
+    words = set(re.findall(r"[a-z0-9]+", str(name).lower()))
+    return bool(words) and words <= METADATA_WORDS
+
+def is_text_column(col: pd.Series) -> bool:
+    import pandas as pd
+
+    return pd.api.types.is_string_dtype(col) or pd.api.types.is_object_dtype(col)
+
+def prune_columns(df: pd.DataFrame) -> pd.DataFrame:
+    pruned = df[[c for c in df.columns if not is_metadata_column(c)]]
+    # Guard against a header row the word list misreads: never drop the only text.
+    had_text = any(is_text_column(df[c]) for c in df.columns)
+    if had_text and not any(is_text_column(pruned[c]) for c in pruned.columns):
+        return df
+    return pruned
+
+def compact(df: pd.DataFrame) -> pd.DataFrame:
+    # PPAP templates carry large blocks of blank (or whitespace-only) rows and columns;
+    # they cost tokens without telling Gemini anything. The index is kept, so row
+    # numbers still match the sheet.
+    df = df.replace(r"^\s*$", float("nan"), regex=True)
+    return df.dropna(how="all").dropna(axis=1, how="all")
+
+# One compact JSON object per row with empty cells, rows and columns dropped: far fewer
+# tokens than CSV for sparse PPAP sheets. Each object carries its spreadsheet row number
+# ("row", header = row 1) so findings can point back to the sheet; the cells sit under
+# "cells" so a column that happens to be named "row" cannot clobber it.
+# Keyed on the upload digest; the frame itself is not hashed.
+@st.cache_data(show_spinner=False)
+def to_llm_payload(file_hash: str, _df: pd.DataFrame) -> str:
+    df = compact(prune_columns(_df))
+    records = df.astype(object).where(df.notna(), None).to_dict(orient="index")
+    return "\n".join(
+        orjson.dumps(
+            {"row": i + 2, "cells": {k: v for k, v in r.items() if v is not None}},
+            default=str, option=orjson.OPT_NON_STR_KEYS
+        ).decode()
+        for i, r in records.items()
+    )
+
+# ======= Prompt context caching =======
+# The instruction prompt is identical for every upload of a document type, so it is
+# stored once as a Gemini cached context and each request only carries the document.
+# Gemini refuses to cache content below the model's minimum token count, so prompts
+# estimated to be smaller are not even offered to it. Caching is only an optimization:
+# if creating the cache fails for any reason, the prompt is sent inline instead.
+PROMPT_CACHE_TTL = 3600  # seconds
+PROMPT_CACHE_MIN_TOKENS = {"gemini-1.5-flash": 32768, "gemini-2.5-pro": 4096}
+CHARS_PER_TOKEN = 4  # rough estimate for English text
+
+@st.cache_resource(ttl=PROMPT_CACHE_TTL - 300)  # drop the handle before Gemini expires it
+def get_prompt_cache(prompt: str, model: str):
+    if len(prompt) / CHARS_PER_TOKEN < PROMPT_CACHE_MIN_TOKENS.get(model, 32768):
+        return None
+    try:
+        cache = get_client().caches.create(
+            model=model,
+            config={
+                "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                "ttl": f"{PROMPT_CACHE_TTL}s"
+            }
         )
+    except Exception:
+        return None
+    return cache.name
+
+# The static parts of a request (response schema config, prompt part) are turned into
+# SDK objects once and reused, so the schema dict is not revalidated on every call and
+# each request only allocates the part holding the document.
+@st.cache_resource
+def get_request_config(schema_json: str, cache_name: str | None, _schema: dict):
+    from google.genai import types
+
+    return types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=_schema,
+        cached_content=cache_name
+    )
+
+@st.cache_resource
+def get_prompt_part(prompt: str):
+    from google.genai import types
+
+    return types.Part.from_text(text=prompt)
+
+def build_request(prompt: str, content_text: str, schema_json: str, schema: dict, model: str) -> dict:
+    from google.genai import types
+
+    cache_name = get_prompt_cache(prompt, model)
+    parts = [types.Part.from_text(text=content_text)]
+    if not cache_name:
+        parts.insert(0, get_prompt_part(prompt))
+    return {
+        "model": model,
+        "contents": [types.Content(role="user", parts=parts)],
+        "config": get_request_config(schema_json, cache_name, schema)
+    }
+
+# ======= Gemini analysis =======
+# Reruns (e.g. clicking "Download JSON") hit the cache instead of re-calling Gemini.
+# The cache key holds a digest of the document and the prebuilt schema JSON string;
+# the document text and schema dict themselves are not hashed and are handed to the
+# SDK as-is.
+# Gemini does not always honour response_schema, so the parsed reply is checked with a
+# compiled validator. A reply that fails gets one corrective reask instead of breaking
+# the tab; if that fails too, the error is raised.
+@st.cache_resource
+def get_validator(schema_json: str):
+    import fastjsonschema
+
+    return fastjsonschema.compile(json.loads(schema_json))
+
+def parse_reply(text: str, schema_json: str) -> dict:
+    result = orjson.loads(text)
+    get_validator(schema_json)(result)
+    return result
+
+@st.cache_data(show_spinner=False, ttl=24 * 3600, max_entries=64)
+def run_gemini(prompt: str, content_hash: str, schema_json: str, model: str,
+               _content_text: str, _schema: dict, _progress: queue.Queue | None = None) -> dict:
+    from fastjsonschema import JsonSchemaException
+
+    request = build_request(prompt, _content_text, schema_json, _schema, model)
+    text = generate(request, _progress)
+    try:
+        return parse_reply(text, schema_json)
+    except (orjson.JSONDecodeError, JsonSchemaException) as exc:
+        reask = {**request, "contents": request["contents"] + [
+            {"role": "model", "parts": [{"text": text}]},
+            {"role": "user", "parts": [{"text": f"The previous output failed schema validation: {exc}. "
+                                                "Return the corrected JSON only."}]}
+        ]}
+        return parse_reply(generate(reask), schema_json)
+
+def analyze(prompt: str, content_text: str, schema_json: str, schema: dict,
+            model: str = "gemini-1.5-flash", progress: queue.Queue | None = None) -> dict:
+    content_hash = xxhash.xxh3_64_hexdigest(content_text.encode())
+    return run_gemini(prompt, content_hash, schema_json, model, content_text, schema, progress)
+
+def with_script_ctx(fn):
+    # Worker threads carry the script's run context, as Streamlit's caches expect.
+    ctx = get_script_run_ctx()
+
+    def run(*args):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+
+    return run
+
+# ======= Sharded analysis =======
+# Large PFMEA / Control Plan sheets are split into shards of SHARD_ROWS payload rows
+# that are analyzed in parallel and merged: latency stays close to one shard's, and no
+# single request approaches Gemini's payload limit. Rows carry their own sheet row
+# numbers, so merged findings need no offset fix-up.
+SHARD_ROWS = 200
+MAX_SHARD_WORKERS = 8
+
+def merge_summaries(a, b):
+    # Counts add up, lists are joined without duplicates and nested objects merge field
+    # by field; free-text fields (outline, Yes/No details) keep the first shard's value.
+    if isinstance(a, dict) and isinstance(b, dict):
+        return {k: merge_summaries(a[k], b[k]) if k in a and k in b else a.get(k, b.get(k))
+                for k in {**a, **b}}
+    if isinstance(a, list) and isinstance(b, list):
+        return a + [item for item in b if item not in a]
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)) and not isinstance(a, bool):
+        return a + b
+    return a
+
+def analyze_document(prompt: str, content_text: str, schema_json: str, schema: dict,
+                     model: str = "gemini-1.5-flash", progress: queue.Queue | None = None) -> dict:
+    rows = content_text.split("\n")
+    if len(rows) <= SHARD_ROWS:
+        return analyze(prompt, content_text, schema_json, schema, model, progress)
+
+    # Only whole results are shown for sharded documents; nothing is streamed.
+    shards = ["\n".join(rows[i:i + SHARD_ROWS]) for i in range(0, len(rows), SHARD_ROWS)]
+    run_shard = with_script_ctx(lambda shard: analyze(prompt, shard, schema_json, schema, model))
+    with ThreadPoolExecutor(max_workers=MAX_SHARD_WORKERS) as pool:
+        results = list(pool.map(run_shard, shards))
+
+    merged = {"summary": results[0]["summary"], "missed_points": []}
+    for result in results:
+        merged["missed_points"].extend(result["missed_points"])
+    for result in results[1:]:
+        merged["summary"] = merge_summaries(merged["summary"], result["summary"])
+    return merged
+
+# ======= Concurrent analysis (Consistency Checker) =======
+# The PFD, CP, PFMEA and consistency requests are independent, so they run concurrently
+# and the tab waits for the slowest one instead of the sum of all four. Each one goes
+# through the same cached calls as the single-document tabs, so a document already
+# analyzed in its own tab is a cache hit here rather than a second Gemini call.
+# Gemini's Batch API is deliberately not used here: batch jobs are queued with a
+# turnaround of minutes to hours, which an interactive tab cannot wait on.
+async def run_all(calls):
+    return await asyncio.gather(*(asyncio.to_thread(with_script_ctx(fn), *args) for fn, *args in calls))
+
+def analyze_all(pfd_txt: str, cp_txt: str, pfmea_txt: str, combined_text: str,
+                model: str = "gemini-1.5-flash", progress: queue.Queue | None = None,
+                known: list | None = None) -> list:
+    # `progress` streams the consistency reply, the one shown live in the tab.
+    # The consistency check needs all three documents at once, so it is never sharded.
+    # `known` holds per-document results already at hand (e.g. stashed by an earlier
+    # fused call, which never reaches the per-document cache); those are not re-run.
+    known = known or [None, None, None]
+    doc_calls = [
+        (analyze_document, pfd_prompt, pfd_txt, PFD_SCHEMA_JSON, pfd_schema, model),
+        (analyze_document, cp_prompt, cp_txt, CP_SCHEMA_JSON, cp_schema, model),
+        (analyze_document, pfmea_prompt, pfmea_txt, PFMEA_SCHEMA_JSON, pfmea_schema, model)
+    ]
+    missing = [call for call, result in zip(doc_calls, known) if result is None]
+    fresh = iter(asyncio.run(run_all(missing + [
+        (analyze, consistency_prompt, combined_text, CONSISTENCY_SCHEMA_JSON, consistency_schema, model, progress)
+    ])))
+    return [next(fresh) if result is None else result for result in known] + [next(fresh)]
+
+# When none of the three documents has a result yet and all of them fit in one shard,
+# the four analyses are asked for in a single call: the documents are sent (and
+# billed) once instead of twice, and one round-trip is saved.
+def can_fuse(doc_results: list, texts: list) -> bool:
+    return not any(doc_results) and all(text.count("\n") < SHARD_ROWS for text in texts)
+
+def analyze_fused(combined_text: str, model: str = "gemini-1.5-flash",
+                  progress: queue.Queue | None = None) -> list:
+    result = analyze(combined_prompt, combined_text, COMBINED_SCHEMA_JSON, combined_schema, model, progress)
+    return [result["pfd"], result["cp"], result["pfmea"], result["consistency"]]
+
+
+# ======= Session result stash =======
+# session_state lives in memory for every connected session, so large results are
+# pickled and gzipped before being stored; small ones are kept as-is.
+STASH_COMPRESS_MIN = 16 * 1024  # bytes
+
+def stash_result(key: str, result) -> None:
+    data = pickle.dumps(result, protocol=5)
+    st.session_state[key] = gzip.compress(data) if len(data) >= STASH_COMPRESS_MIN else result
+
+def load_stashed(key: str):
+    value = st.session_state.get(key)
+    if isinstance(value, bytes):
+        return pickle.loads(gzip.decompress(value))
+    return value
+
+
+# ======= Excel export =======
+# Rows are streamed straight into the workbook (constant_memory flushes each row as it
+# is written) instead of going through a DataFrame and pandas' ExcelWriter.
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def json_to_excel(rows: list, sheet_name: str = "Analysis") -> bytes:
+    import xlsxwriter
+
+    buf = io.BytesIO()
+    wb = xlsxwriter.Workbook(buf, {"constant_memory": True})
+    ws = wb.add_worksheet(sheet_name)
+    if rows:
+        cols = list(dict.fromkeys(col for row in rows for col in row))
+        ws.write_row(0, 0, cols)
+        for r, row in enumerate(rows, 1):
+            ws.write_row(r, 0, [row.get(c, "") for c in cols])
+    wb.close()
+    return buf.getvalue()
 
-       result = json.loads(response.text)
-
-       st.subheader("✅ JSON Output")
-       st.json(result)
 
-    # ======= Display as HTML table =======
-       if result.get("missed_points"):
-           df_missed = pd.DataFrame(result["missed_points"])
-           st.subheader("📊 Missed Points (HTML Table)")
-           st.write(df_missed.to_html(index=False, escape=False), unsafe_allow_html=True)
-
-    # Download JSON
-       st.download_button(
-           "Download JSON",
-           json.dumps(result, indent=2),
-           file_name="pfd_analysis_output.json"
-       )
-# --- Control Plan Analyzer ---
-with tabs[1]:
-   st.title("📗 AIAG Control Plan Analyzer")
-   uploaded_file = st.file_uploader("Upload Control Plan (Excel or CSV)", type=["xlsx", "csv"])
-
-   if uploaded_file:
-       if uploaded_file.name.endswith(".csv"):
-           df = pd.read_csv(uploaded_file)
-       else:
-           df = pd.read_excel(uploaded_file)
-
-       st.subheader("Preview of uploaded file")
-       st.dataframe(df.head())
-
-       content_text = df.to_csv(index=False)
-
-    # Call Gemini
-       with st.spinner("Analyzing Control Plan..."):
-           response = client.models.generate_content(
-               model="gemini-1.5-flash",
-               contents=[{"parts": [{"text": cp_prompt}, {"text": content_text}]}],
-               config={"response_mime_type": "application/json", "response_schema": cp_schema}
-           )
-
-       result = json.loads(response.text)
-
-       st.subheader("✅ JSON Output")
-       st.json(result)
-
-    # ======= Display missed points as HTML table =======
-       if result.get("missed_points"):
-           df_missed = pd.DataFrame(result["missed_points"])
-           st.subheader("📊 Missed Points (HTML Table)")
-           st.write(df_missed.to_html(index=False, escape=False), unsafe_allow_html=True)
-
-    # Download JSON
-       st.download_button(
-           "Download JSON",
-           json.dumps(result, indent=2),
-           file_name="control_plan_analysis.json"
-       )
-# --- PFMEA Analyzer ---
-with tabs[2]:
-   st.title("📕 AIAG PFMEA Analyzer")
-   uploaded_file = st.file_uploader("Upload PFMEA (Excel or CSV)", type=["xlsx", "csv"])
-
-   if uploaded_file:
-       if uploaded_file.name.endswith(".csv"):
-           df = pd.read_csv(uploaded_file)
-       else:
-           df = pd.read_excel(uploaded_file)
-
-       st.subheader("Preview of uploaded file")
-       st.dataframe(df.head())
-
-       content_text = df.to_csv(index=False)
-
-    # Call Gemini
-       with st.spinner("Analyzing PFMEA..."):
-           response = client.models.generate_content(
-               model="gemini-1.5-flash",
-               contents=[{"parts": [{"text": pfmea_prompt}, {"text": content_text}]}],
-               config={"response_mime_type": "application/json", "response_schema": pfmea_schema}
+# ======= Streamlit UI =======
+# Each tab is a fragment: interacting with a widget inside a tab (e.g. the download
+# button) reruns only that tab instead of the whole app.
+
+# Result tables go through st.dataframe (Arrow, virtualized) rather than raw HTML.
+SEVERITY_COLUMN = {"severity": st.column_config.TextColumn("Severity", width="small")}
+
+# ======= Live results =======
+# While Gemini streams its reply, the rows of the issues array that are already complete
+# are shown, so the user sees the first findings instead of a bare spinner.
+def partial_items(text: str, key: str) -> list:
+    # Complete objects of the `key` array in a JSON document that is still arriving.
+    start = text.find(f'"{key}"')
+    pos = text.find("[", start) + 1 if start >= 0 else 0
+    if not pos:
+        return []
+    decoder = json.JSONDecoder()
+    items = []
+    while True:
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(text) or text[pos] == "]":
+            return items
+        try:
+            item, pos = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            return items
+        items.append(item)
+
+def run_live(fn, key: str):
+    # Runs fn(progress) on a worker thread and renders its streamed `key` rows here.
+    # On a cache hit nothing is streamed and fn returns straight away.
+    placeholder = st.empty()
+    progress = queue.Queue()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(with_script_ctx(fn), progress)
+        shown = 0
+        while not future.done():
+            try:
+                text = progress.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            while not progress.empty():
+                text = progress.get_nowait()
+            rows = partial_items(text, key)
+            if len(rows) > shown:
+                placeholder.dataframe(rows, hide_index=True, column_config=SEVERITY_COLUMN)
+                shown = len(rows)
+    placeholder.empty()
+    return future.result()
+
+# --- Result output (shared by all tabs) ---
+def render_result(result, issues_key, issues_title, download_name, column_config=None):
+    st.subheader("✅ JSON Output")
+    st.json(result)
+
+    # ======= Display issues table =======
+    if result.get(issues_key):
+        st.subheader(issues_title)
+        st.dataframe(result[issues_key], hide_index=True, column_config=column_config)
+
+    # Download JSON (orjson bytes are passed through without decoding)
+    st.download_button(
+        "Download JSON",
+        orjson.dumps(result, option=orjson.OPT_INDENT_2),
+        file_name=download_name,
+        mime="application/json"
+    )
+
+    # Download the issues table as Excel; the workbook is only built when the button
+    # is clicked, not on every rerun
+    if result.get(issues_key):
+        st.download_button(
+            "Download Excel",
+            lambda: json_to_excel(result[issues_key], issues_key.replace("_", " ").title()),
+            file_name=download_name.replace(".json", ".xlsx"),
+            mime=XLSX_MIME
         )
 
-       result = json.loads(response.text)
-
-       st.subheader("✅ JSON Output")
-       st.json(result)
-
-    # ======= Display missed points as HTML table =======
-       if result.get("missed_points"):
-           df_missed = pd.DataFrame(result["missed_points"])
-           st.subheader("📊 Missed Points (HTML Table)")
-           st.write(df_missed.to_html(index=False, escape=False), unsafe_allow_html=True)
-
-    # Download JSON
-       st.download_button(
-           "Download JSON",
-           json.dumps(result, indent=2),
-           file_name="pfmea_analysis.json"
-       )
-#consistency checker
-with tabs[3]:
-   st.title("🔗 AIAG Consistency Checker (PFD ↔ CP ↔ PFMEA)")
-   uploaded_pfd = st.file_uploader("Upload PFD", type=["xlsx", "csv"], key="cons_pfd")
-   uploaded_cp = st.file_uploader("Upload Control Plan", type=["xlsx", "csv"], key="cons_cp")
-   uploaded_pfmea = st.file_uploader("Upload PFMEA", type=["xlsx", "csv"], key="cons_pfmea")
-
-   if uploaded_pfd and uploaded_cp and uploaded_pfmea:
-       df_pfd = pd.read_csv(uploaded_pfd) if uploaded_pfd.name.endswith(".csv") else pd.read_excel(uploaded_pfd)
-       df_cp = pd.read_csv(uploaded_cp) if uploaded_cp.name.endswith(".csv") else pd.read_excel(uploaded_cp)
-       df_pfmea = pd.read_csv(uploaded_pfmea) if uploaded_pfmea.name.endswith(".csv") else pd.read_excel(uploaded_pfmea)
-
-       st.subheader("Preview of uploaded documents")
-       st.write("📘 PFD"); st.dataframe(df_pfd.head())
-       st.write("📗 Control Plan"); st.dataframe(df_cp.head())
-       st.write("📕 PFMEA"); st.dataframe(df_pfmea.head())
-
-       combined_text = f"""
+# --- Documents shared between tabs ---
+# A sheet uploaded in its own analyzer tab is kept in session_state (digest, name and
+# parsed DataFrame) so the Consistency Checker can use it without a second upload.
+def share_document(key, doc=None):
+    slot = f"doc_{key}"
+    old_hash = st.session_state[slot]["hash"] if slot in st.session_state else None
+    if old_hash == (doc["hash"] if doc else None):
+        return
+    if doc is None:
+        del st.session_state[slot]
+    else:
+        st.session_state[slot] = doc
+    # Fragments only rerun themselves; rerun the app so the Consistency tab sees it.
+    st.rerun()
+
+def shared_upload(key, label):
+    # The Consistency tab always has its own uploader; a file uploaded there wins over
+    # the one from the analyzer tab, which is only the fallback. The last value tells
+    # whether the document came from the analyzer tab.
+    uploaded_file = st.file_uploader(f"Upload {label}", type=["xlsx", "csv"], key=f"cons_{key}")
+    if uploaded_file is not None:
+        return file_digest(uploaded_file), read_upload(uploaded_file), False
+    doc = st.session_state.get(f"doc_{key}")
+    if doc is not None:
+        st.caption(f"Using {doc['name']} from the {label} tab; upload a file above to use a different one.")
+        return doc["hash"], doc["df"], True
+    return None, None, False
+
+# --- PFD / Control Plan / PFMEA Analyzers ---
+@st.fragment
+def run_analyzer(title, label, prompt, schema, schema_json, key, download_name):
+    st.title(title)
+    uploaded_file = st.file_uploader(f"Upload {label} (Excel or CSV)", type=["xlsx", "csv"], key=f"{key}_upload")
+    model = st.selectbox("Model", MODELS, index=0, key=f"{key}_model")
+
+    if not uploaded_file:
+        share_document(key)
+    else:
+        df = read_upload(uploaded_file)
+        file_hash = file_digest(uploaded_file)
+        share_document(key, {"hash": file_hash, "name": uploaded_file.name, "df": df})
+
+        st.subheader("Preview of uploaded file")
+        st.dataframe(preview(df))
+
+        # Reuse the result stashed for this upload; only call Gemini when it is missing
+        result_key = f"{key}_result::{model}:{file_hash}"
+        result = load_stashed(result_key)
+        if result is None:
+            content_text = to_llm_payload(file_hash, df)
+
+            # Call Gemini
+            with st.spinner(f"Analyzing {label}..."):
+                result = run_live(
+                    lambda progress: analyze_document(prompt, content_text, schema_json, schema, model, progress),
+                    "missed_points"
+                )
+            stash_result(result_key, result)
+
+        render_result(result, "missed_points", "📊 Missed Points", download_name, SEVERITY_COLUMN)
+
+# --- Consistency Checker ---
+@st.fragment
+def consistency_tab():
+    st.title("🔗 AIAG Consistency Checker (PFD ↔ CP ↔ PFMEA)")
+    pfd_hash, df_pfd, pfd_shared = shared_upload("pfd", "PFD")
+    cp_hash, df_cp, cp_shared = shared_upload("cp", "Control Plan")
+    pfmea_hash, df_pfmea, pfmea_shared = shared_upload("pfmea", "PFMEA")
+    model = st.selectbox("Model", MODELS, index=0, key="cons_model")
+
+    if pfd_hash and cp_hash and pfmea_hash:
+        st.subheader("Preview of uploaded documents")
+        st.write("📘 PFD"); st.dataframe(preview(df_pfd))
+        st.write("📗 Control Plan"); st.dataframe(preview(df_cp))
+        st.write("📕 PFMEA"); st.dataframe(preview(df_pfmea))
+
+        doc_keys = [f"{key}_result::{model}:{file_hash}"
+                    for key, file_hash in (("pfd", pfd_hash), ("cp", cp_hash), ("pfmea", pfmea_hash))]
+        result_key = f"consistency_result::{model}:{pfd_hash}:{cp_hash}:{pfmea_hash}"
+        results = load_stashed(result_key)
+        # Every tab body runs on each app rerun, so documents picked up from the analyzer
+        # tabs only trigger the (billed) check on request; uploads made here run it
+        # straight away, as before.
+        if results is None and (pfd_shared or cp_shared or pfmea_shared):
+            if not st.button("Run consistency check", key="cons_run"):
+                return
+        if results is None:
+            pfd_text = to_llm_payload(pfd_hash, df_pfd)
+            cp_text = to_llm_payload(cp_hash, df_cp)
+            pfmea_text = to_llm_payload(pfmea_hash, df_pfmea)
+
+            combined_text = f"""
       === PFD ===
-      {df_pfd.to_csv(index=False)}
+      {pfd_text}
 
       === CONTROL PLAN ===
-      {df_cp.to_csv(index=False)}
+      {cp_text}
 
       === PFMEA ===
-      {df_pfmea.to_csv(index=False)}
+      {pfmea_text}
       """
 
-       with st.spinner("Checking cross-linkages..."):
-           response_consistency = client.models.generate_content(
-               model="gemini-1.5-flash",
-               contents=[{"parts": [{"text": consistency_prompt}, {"text": combined_text}]}],
-               config={"response_mime_type": "application/json", "response_schema": consistency_schema}
-           )
-
-       consistency_result = json.loads(response_consistency.text)
-
-       st.subheader("✅ JSON Output")
-       st.json(consistency_result)
-
-    # ======= Display missing links as HTML table =======
-       if consistency_result.get("missing_links"):
-           df_missing = pd.DataFrame(consistency_result["missing_links"])
-           st.subheader("📊 Missing Links (HTML Table)")
-           st.write(df_missing.to_html(index=False, escape=False), unsafe_allow_html=True)
-
-    # Download JSON
-       st.download_button(
-           "Download JSON",
-           json.dumps(consistency_result, indent=2),
-           file_name="consistency_analysis.json"
-       )
-
-
-
+            known = [load_stashed(k) for k in doc_keys]
+            if can_fuse(known, [pfd_text, cp_text, pfmea_text]):
+                run = lambda progress: analyze_fused(combined_text, model, progress)
+            else:
+                run = lambda progress: analyze_all(pfd_text, cp_text, pfmea_text, combined_text, model, progress, known)
+            with st.spinner("Analyzing documents and checking cross-linkages..."):
+                results = run_live(run, "missing_links")
+            stash_result(result_key, results)
+            # The per-document results also serve the analyzer tabs for these uploads
+            for doc_key, doc_result in zip(doc_keys, results):
+                if load_stashed(doc_key) is None:
+                    stash_result(doc_key, doc_result)
+        pfd_result, cp_result, pfmea_result, consistency_result = results
+
+        st.subheader("Individual document analyses")
+        with st.expander("📘 PFD"):
+            st.json(pfd_result)
+        with st.expander("📗 Control Plan"):
+            st.json(cp_result)
+        with st.expander("📕 PFMEA"):
+            st.json(pfmea_result)
+
+        render_result(consistency_result, "missing_links", "📊 Missing Links", "consistency_analysis.json")
 
 
+st.title("📊 AIAG PPAP Analyzer Suite")
+tabs = st.tabs([
+    "🔹 PFD Analyzer",
+    "🔹 Control Plan Analyzer",
+    "🔹 PFMEA Analyzer",
+    "🔹 Consistency Checker"
+])
 
+with tabs[0]:
+    run_analyzer(
+        "📘 AIAG PFD Analyzer (APQP 3rd Edition)", "PFD",
+        pfd_prompt, pfd_schema, PFD_SCHEMA_JSON, "pfd", "pfd_analysis_output.json"
+    )
+with tabs[1]:
+    run_analyzer(
+        "📗 AIAG Control Plan Analyzer", "Control Plan",
+        cp_prompt, cp_schema, CP_SCHEMA_JSON, "cp", "control_plan_analysis.json"
+    )
+with tabs[2]:
+    run_analyzer(
+        "📕 AIAG PFMEA Analyzer", "PFMEA",
+        pfmea_prompt, pfmea_schema, PFMEA_SCHEMA_JSON, "pfmea", "pfmea_analysis.json"
+    )
+with tabs[3]:
+    consistency_tab()
@@ -0,0 +1,247 @@
+import json
+
+# ======= Shared sub-schemas =======
+# Building blocks referenced (not copied) by every schema below.
+STRING = {"type": "string"}
+INTEGER = {"type": "integer"}
+STRING_LIST = {"type": "array", "items": STRING}
+
+MISSED_POINT_ITEM = {
+    "type": "object",
+    "properties": {
+        "issue": STRING,
+        "severity": STRING,
+        "row_content": STRING,
+        "suggestion": STRING
+    },
+    "required": ["issue", "severity", "row_content", "suggestion"]
+}
+MISSED_POINTS_ARRAY = {"type": "array", "items": MISSED_POINT_ITEM}
+
+def analysis_schema(summary_properties, issues_key="missed_points", issues_schema=MISSED_POINTS_ARRAY):
+    # Every summary field is required, in declaration order.
+    return {
+        "type": "object",
+        "properties": {
+            "summary": {
+                "type": "object",
+                "properties": summary_properties,
+                "required": list(summary_properties)
+            },
+            issues_key: issues_schema
+        },
+        "required": ["summary", issues_key]
+    }
+
+# ======= Shared prompt parts =======
+# Every prompt is one persona, one input description and one output contract around a
+# per-analysis task and key list, so the combined prompt can reuse the same pieces
+# without repeating (or contradicting) any of them.
+PERSONA = "You are a Quality Assurance assistant for PPAP documentation."
+INPUT_FORMAT = """Documents are given as JSON Lines, one object per spreadsheet row: "row" is the spreadsheet row number and
+"cells" maps column header to value, with empty cells omitted."""
+
+def analysis_prompt(task, output):
+    return f"""
+{PERSONA}
+{task}
+{INPUT_FORMAT}
+
+Return JSON only with two keys:
+
+{output}"""
+
+# ======= PFD Prompt (updated for row_content) =======
+pfd_task = """Analyze the provided Process Flow Diagram (PFD).
+Use the latest AIAG guidance (APQP 3rd Edition, March 2024)."""
+
+pfd_output = """1. summary:
+   - product_outline: story-like description of the product/component
+   - total_steps
+   - machines_tools_list
+   - special_characteristics_count
+   - pfmea_refs
+   - control_plan_refs
+
+2. missed_points:
+   - Array of objects:
+     - issue
+     - severity (high/medium/low)
+     - row_content (string: include the full row content from the PFD)
+     - suggestion
+"""
+pfd_prompt = analysis_prompt(pfd_task, pfd_output)
+
+# ======= Updated schema =======
+pfd_schema = analysis_schema({
+    "product_outline": STRING,
+    "total_steps": INTEGER,
+    "machines_tools_list": STRING_LIST,
+    "special_characteristics_count": INTEGER,
+    "pfmea_refs": STRING_LIST,
+    "control_plan_refs": STRING_LIST
+})
+PFD_SCHEMA_JSON = json.dumps(pfd_schema, sort_keys=True)
+# ======= Control Plan Prompt (updated for row_content) =======
+cp_task = """Analyze the provided Control Plan (CP).
+Use the latest AIAG guidance (Control Plan Reference Manual – 1st Edition, March 2024)."""
+
+cp_output = """1. summary:
+   - product_outline: story-like description of the product/component
+   - total_control_items
+   - safe_launch_controls (count + description)
+   - ownership_clarity (Yes/No + details)
+   - automation_readiness (Yes/No + comments)
+
+2. missed_points:
+   - Array of objects:
+     - issue
+     - severity (high/medium/low)
+     - row_content (string: include the full row content from the Control Plan)
+     - suggestion
+"""
+cp_prompt = analysis_prompt(cp_task, cp_output)
+
+# ======= Updated schema =======
+cp_schema = analysis_schema({
+    "product_outline": STRING,
+    "total_control_items": INTEGER,
+    "safe_launch_controls": {
+        "type": "object",
+        "properties": {"count": INTEGER, "description": STRING}
+    },
+    "ownership_clarity": STRING,
+    "automation_readiness": STRING
+})
+CP_SCHEMA_JSON = json.dumps(cp_schema, sort_keys=True)
+# ======= PFMEA Prompt (updated for row_content) =======
+pfmea_task = """Analyze the provided PFMEA.
+Use the latest AIAG-VDA FMEA Handbook (2019) as reference."""
+
+pfmea_output = """1. summary:
+   - product_outline: story-like description of the process/product
+   - total_failure_modes
+   - high_rpn_count
+   - action_priority_summary (high/medium/low counts)
+   - linkage_to_pfd (Yes/No + details)
+   - linkage_to_control_plan (Yes/No + details)
+
+2. missed_points:
+   - Array of objects:
+     - issue
+     - severity (high/medium/low)
+     - row_content (string: include the full row content from the PFMEA)
+     - suggestion
+"""
+pfmea_prompt = analysis_prompt(pfmea_task, pfmea_output)
+
+# ======= Updated PFMEA schema =======
+pfmea_schema = analysis_schema({
+    "product_outline": STRING,
+    "total_failure_modes": INTEGER,
+    "high_rpn_count": INTEGER,
+    "action_priority_summary": {
+        "type": "object",
+        "properties": {"high": INTEGER, "medium": INTEGER, "low": INTEGER}
+    },
+    "linkage_to_pfd": STRING,
+    "linkage_to_control_plan": STRING
+})
+PFMEA_SCHEMA_JSON = json.dumps(pfmea_schema, sort_keys=True)
+# ======= Consistency Prompt =======
+consistency_task = """Check the consistency between Process Flow Diagram (PFD), Control Plan (CP), and PFMEA.
+Rules:
+- Every process step in PFD must appear in Control Plan.
+- Every control in Control Plan must be referenced in PFMEA.
+- Any missing linkage must be identified."""
+
+consistency_output = """1. summary:
+   - total_pfd_steps
+   - total_cp_controls
+   - total_pfmea_entries
+   - linked_pfd_to_cp (count)
+   - linked_cp_to_pfmea (count)
+   - linkage_completeness (percentage of proper linkages)
+
+2. missing_links:
+   - Array of objects:
+     - from_document (PFD / CP)
+     - missing_in (CP / PFMEA)
+     - row_content (string: include the full row content causing the missing linkage)
+     - description
+     - suggestion
+"""
+consistency_prompt = analysis_prompt(consistency_task, consistency_output)
+
+# ======= Updated Consistency Schema =======
+consistency_schema = analysis_schema(
+    {
+        "total_pfd_steps": INTEGER,
+        "total_cp_controls": INTEGER,
+        "total_pfmea_entries": INTEGER,
+        "linked_pfd_to_cp": INTEGER,
+        "linked_cp_to_pfmea": INTEGER,
+        "linkage_completeness": {"type": "number"}
+    },
+    issues_key="missing_links",
+    issues_schema={
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "from_document": STRING,
+                "missing_in": STRING,
+                "row_content": STRING,
+                "description": STRING,
+                "suggestion": STRING
+            },
+            "required": ["from_document", "missing_in", "row_content", "description", "suggestion"]
+        }
+    }
+)
+CONSISTENCY_SCHEMA_JSON = json.dumps(consistency_schema, sort_keys=True)
+
+# ======= Combined Prompt (all four analyses in one call) =======
+# Used by the Consistency Checker when none of the documents has been analyzed on its
+# own yet: Gemini reads the three documents once instead of once per analysis.
+combined_prompt = f"""
+{PERSONA}
+You are given a PFD, a Control Plan and a PFMEA in one input, under the headers
+=== PFD ===, === CONTROL PLAN === and === PFMEA ===.
+{INPUT_FORMAT}
+
+Return JSON only with four keys: pfd, cp, pfmea and consistency. Each holds an object
+with the two keys listed under its header below.
+
+--- pfd (PFD section only) ---
+{pfd_task}
+
+{pfd_output}
+--- cp (Control Plan section only) ---
+{cp_task}
+
+{cp_output}
+--- pfmea (PFMEA section only) ---
+{pfmea_task}
+
+{pfmea_output}
+--- consistency (all three documents) ---
+{consistency_task}
+
+{consistency_output}"""
+
+# ======= Combined Schema =======
+# propertyOrdering keeps the consistency result last, so it is still the one streaming
+# in while the tab shows live rows.
+combined_schema = {
+    "type": "object",
+    "properties": {
+        "pfd": pfd_schema,
+        "cp": cp_schema,
+        "pfmea": pfmea_schema,
+        "consistency": consistency_schema
+    },
+    "required": ["pfd", "cp", "pfmea", "consistency"],
+    "propertyOrdering": ["pfd", "cp", "pfmea", "consistency"]
+}
+COMBINED_SCHEMA_JSON = json.dumps(combined_schema, sort_keys=True)